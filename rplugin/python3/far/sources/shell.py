@@ -18,10 +18,224 @@ import tempfile
 import pathlib
 import json
 import io
+import array
+import queue
+import signal
+import threading
 from json import JSONDecodeError
 
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dump_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    json_loads = json.loads
+
+    def json_dump_line(obj):
+        return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 logger = logging.getLogger('far')
 
+# Read buffer for the search tool pipes, so lines are taken from large
+# block reads instead of a read() syscall per line.
+PIPE_BUFSIZE = 1 << 20
+ITEMS_FILE_BUFSIZE = 1 << 20
+READ_BLOCK_SIZE = 256 << 10
+MAX_QUEUED_BATCHES = 64
+
+# file:line:column:text, as printed by the grep-like search tools
+LINE_RE = re.compile(rb'^([^:]+):(\d+):(\d+):(.*)$')
+
+# Placeholder printed by rg for lines longer than --max-columns
+OMITTED_LINE_RE = re.compile(
+    rb'^\[Omitted long (line with \d+ matches|matching line|context line)\]$')
+
+# Vim's \C and \c case flags in a search pattern
+CASE_FLAG_RE = re.compile(r'(\\+)([Cc])')
+
+
+def iter_lines(stream):
+    '''
+    Yield the lines of a binary stream, reading it from a separate thread.
+
+    The reader thread pulls large blocks from the stream and splits them into
+    batches of lines, so draining the pipe overlaps with the caller parsing
+    the lines already read. Lines are yielded without the trailing newline.
+    '''
+    batches = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+    stop = threading.Event()
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        # Pieces of the current, unfinished line. They are only joined once
+        # the line ends, so a very long line is not copied for every block.
+        residual = []
+        try:
+            while not stop.is_set():
+                block = stream.read1(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                end = block.rfind(b'\n')
+                if end == -1:
+                    residual.append(block)
+                    continue
+                residual.append(block[:end])
+                lines = b''.join(residual).split(b'\n')
+                residual = [block[end + 1:]]
+                put(lines)
+            residual = b''.join(residual)
+            if residual:
+                put([residual])
+        except Exception as e:
+            logger.debug('iter_lines read error: ' + str(e))
+        finally:
+            put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            yield from batch
+    finally:
+        stop.set()
+
+
+class StreamDrain:
+    '''
+    Read a stream to its end on a separate thread.
+
+    Keeps a child process from blocking on a full pipe that is only read
+    once its other output has been consumed.
+    '''
+
+    def __init__(self, stream):
+        self.data = b''
+        self.thread = threading.Thread(target=self._read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream):
+        try:
+            self.data = stream.read()
+        except Exception as e:
+            logger.debug('StreamDrain read error: ' + str(e))
+
+    def read(self):
+        self.thread.join()
+        return self.data
+
+    def readline(self):
+        return io.BytesIO(self.read()).readline()
+
+
+def has_option(opts, short, long):
+    '''
+    Tell whether a command line option is set in any of its forms: the short
+    option alone or with the value attached (-m, -m5), the long option with
+    the value as the next argument or after '=' (--max-count, --max-count=5).
+    Scanning stops at '--', which ends the options.
+    '''
+    for opt in opts:
+        if opt == '--':
+            break
+        if opt in (short, long) or opt.startswith(long + '=') or \
+           (opt.startswith(short) and opt[len(short):].isdigit()):
+            return True
+    return False
+
+
+def decode_output(data):
+    '''
+    Decode a piece of the search tool output, taking the cheaper ASCII
+    decoder for pure ASCII bytes, which is the common case in code.
+    '''
+    if data.isascii():
+        return str(data, 'ascii')
+    return data.decode('utf-8', 'replace')
+
+
+def write_stdin(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except Exception as e:
+        logger.debug('write_stdin error: ' + str(e))
+
+
+class ItemsFile:
+    '''
+    Temporary file with the search results, one file context per line.
+
+    The search tools print the matches of a file together, so a file context
+    is written out and dropped as soon as the matches of the next file start,
+    instead of keeping all results in memory until the search ends.
+
+    The matches of the current file are kept in columns (line and column
+    numbers in arrays, texts and matched strings in lists) and only turned
+    into the item dicts expected by the vim side when written out.
+    '''
+
+    def __init__(self):
+        self.fp = None
+        self.fname = None
+        self.lnums = array.array('l')
+        self.cnums = array.array('l')
+        self.texts = []
+        self.matches = []
+        self.empty = True
+
+    def add(self, file_name, lnum, cnum, text, match=None):
+        if file_name != self.fname:
+            self.flush()
+            self.fname = file_name
+            self.empty = False
+        self.lnums.append(lnum)
+        self.cnums.append(cnum)
+        self.texts.append(text)
+        self.matches.append(match)
+
+    def _open(self):
+        if self.fp is None:
+            # Serialized file contexts are collected in a large buffer and
+            # hit the disk in few big writes.
+            self.fp = tempfile.NamedTemporaryFile(mode='wb', delete=False,
+                                                  buffering=ITEMS_FILE_BUFSIZE)
+
+    def flush(self):
+        if not self.texts:
+            return
+        items = []
+        for lnum, cnum, text, match in zip(self.lnums, self.cnums,
+                                           self.texts, self.matches):
+            item_ctx = {'lnum': lnum, 'cnum': cnum, 'text': text}
+            if match is not None:
+                item_ctx['match'] = match
+            items.append(item_ctx)
+        self._open()
+        self.fp.write(json_dump_line({'fname': self.fname, 'items': items}))
+        del self.lnums[:], self.cnums[:], self.texts[:], self.matches[:]
+
+    def close(self):
+        self.flush()
+        self._open()
+        self.fp.close()
+        return self.fp.name
+
 
 class MultiProc:
     def __init__(self, cmd, files, cwd):
@@ -30,28 +244,27 @@ class MultiProc:
         self.cwd = cwd
         self.file_idx = 0
         self.proc = None
-        self.returncode = None
         self.ARG_MAX = 30000
         self.all_stderr = b''
+        # The children are spawned from the thread reading stdout, while
+        # terminate() is called from the search thread.
+        self.lock = threading.Lock()
+        self.terminated = False
 
         self._next_proc()
 
     def _next_proc(self):
         if self.proc:
-            try:
-                err = self.proc.stderr.read()
-                if err:
-                    self.all_stderr += err
-            except Exception as e:
-                logger.debug('MultiProc read stderr error: ' + str(e))
-
+            self.all_stderr += self.stderr_drain.read()
             self.proc.wait()
 
-        if self.file_idx >= len(self.files):
-            self.proc = None
-            self.returncode = 0
-            return
+        with self.lock:
+            if self.terminated or self.file_idx >= len(self.files):
+                self.proc = None
+                return
+            self._spawn()
 
+    def _spawn(self):
         current_cmd = list(self.cmd)
         cmd_len = sum(len(arg) + 1 for arg in current_cmd)
 
@@ -72,17 +285,9 @@ class MultiProc:
         current_cmd.extend(chunk)
         logger.debug('MultiProc cmd: %s', str(current_cmd))
 
-        self.proc = subprocess.Popen(current_cmd, cwd=self.cwd,
+        self.proc = subprocess.Popen(current_cmd, cwd=self.cwd, bufsize=PIPE_BUFSIZE,
                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    def poll(self):
-        if self.proc:
-            if self.proc.poll() is None:
-                return None
-
-        if self.file_idx >= len(self.files) and self.proc is None:
-            return self.returncode
-        return None
+        self.stderr_drain = StreamDrain(self.proc.stderr)
 
     @property
     def stdout(self):
@@ -92,20 +297,21 @@ class MultiProc:
     def stderr(self):
         return io.BytesIO(self.all_stderr)
 
-    def readline(self):
-        if not self.proc:
-            return b''
-
-        line = self.proc.stdout.readline()
-        if not line:
+    def read1(self, size=-1):
+        while True:
+            proc = self.proc
+            if not proc:
+                return b''
+            data = proc.stdout.read1(size)
+            if data:
+                return data
             self._next_proc()
-            return self.readline()
-
-        return line
 
     def terminate(self):
-        if self.proc:
-            self.proc.terminate()
+        with self.lock:
+            self.terminated = True
+            if self.proc:
+                self.proc.terminate()
 
 
 def search(ctx, args, cmdargs):
@@ -119,49 +325,19 @@ def search(ctx, args, cmdargs):
     source = ctx['source']
     pattern = ctx['pattern']
 
-    # Manual parsing to handle \C and \c flags
+    # Handle \C and \c flags. An odd run of backslashes before C/c makes a
+    # flag, an even run is an escaped backslash followed by a literal C/c.
     if source in ('rg', 'rgnvim'):
-        new_pattern = []
-        i = 0
-        n = len(pattern)
-        while i < n:
-            if pattern[i] == '\\':
-                # Count consecutive backslashes
-                start = i
-                i += 1
-                while i < n and pattern[i] == '\\':
-                    i += 1
-                backslashes = i - start
-
-                # Check next char
-                if i < n and pattern[i] in ('C', 'c'):
-                    char = pattern[i]
-                    if backslashes % 2 == 1:
-                        # Odd backslashes + C/c -> Flag
-                        # Append (backslashes - 1) backslashes
-                        new_pattern.append('\\' * (backslashes - 1))
-                        if char == 'C':
-                            if '--case-sensitive' not in cmdargs:
-                                cmdargs.append('--case-sensitive')
-                        elif char == 'c':
-                            if '--ignore-case' not in cmdargs:
-                                cmdargs.append('--ignore-case')
-                        i += 1  # Skip C/c
-                        continue
-                    else:
-                        # Even backslashes + C/c -> Literal
-                        new_pattern.append('\\' * backslashes)
-                        new_pattern.append(char)
-                        i += 1
-                        continue
-                else:
-                    # Just backslashes followed by something else
-                    new_pattern.append('\\' * backslashes)
-                    continue
-            else:
-                new_pattern.append(pattern[i])
-                i += 1
-        pattern = ''.join(new_pattern)
+        def case_flag(m):
+            backslashes, char = m.group(1), m.group(2)
+            if len(backslashes) % 2 == 0:
+                return backslashes + char
+            flag = '--case-sensitive' if char == 'C' else '--ignore-case'
+            if flag not in cmdargs:
+                cmdargs.append(flag)
+            return backslashes[:-1]
+
+        pattern = CASE_FLAG_RE.sub(case_flag, pattern)
 
     regex = ctx['regex']
     case_sensitive = ctx['case_sensitive']
@@ -222,11 +398,13 @@ def search(ctx, args, cmdargs):
             return {'error': 'No files matching the glob expression'}
     elif glob_mode == 'rg':
         # Use ripgrep to glob
-        rg_glob_cmd = f'rg --files --no-ignore {rg_rules_glob(rules)} {rg_ignore_globs(ignore_files)}'
+        rg_glob_cmd = ['rg', '--files', '--no-ignore'] + \
+            rg_rules_glob(rules, False) + rg_ignore_globs(ignore_files, False)
         logger.debug(f'Globbing with ripgrep: {rg_glob_cmd}')
         try:
-            output = subprocess.check_output(rg_glob_cmd, shell=True, cwd=root)
-            files = output.decode(preferred_encoding).splitlines()
+            output = subprocess.check_output(rg_glob_cmd, cwd=root)
+            # Kept as bytes; only decoded below if not piped to xargs as is.
+            files = [f for f in output.splitlines() if f]
         except subprocess.CalledProcessError as e:
             logger.debug(f'rg globbing failed: {e}')
             files = []
@@ -245,21 +423,100 @@ def search(ctx, args, cmdargs):
     else:
         return {'error': 'Invalid glob_mode'}
 
+    # rg's JSON output is only needed for the matched text of each submatch.
+    # Otherwise rg prints the much smaller --vimgrep output, one line per
+    # match, which is parsed like the output of the other tools.
+    rg_json = source in ('rg', 'rgnvim') and submatch_type == 'all'
+    rg_vimgrep = source in ('rg', 'rgnvim') and not rg_json
+    # Look for further matches on each reported line, unless the tool
+    # already reports every match.
+    find_submatches = submatch_type == 'first' and not rg_vimgrep
+
+    # Compile the pattern before the tool is started, so that an invalid
+    # pattern leaves nothing to clean up.
+    if find_submatches:
+        if regex != '0':
+            try:
+                if case_sensitive == '0':
+                    cpat = re.compile(pattern, re.IGNORECASE)
+                else:
+                    cpat = re.compile(pattern)
+            except Exception as e:
+                return {'error': 'invalid pattern: ' + str(e)}
+            # RE2 matches in linear time, but its \w, \b, \d and \s only
+            # match ASCII, so it is only used on ASCII lines, where it agrees
+            # with re. Patterns RE2 doesn't support (e.g. backreferences)
+            # always use re.
+            ascii_cpat = cpat
+            if re2:
+                try:
+                    if case_sensitive == '0':
+                        ascii_cpat = re2.compile('(?i)' + pattern)
+                    else:
+                        ascii_cpat = re2.compile(pattern)
+                except Exception as e:
+                    logger.debug('re2 compile error: ' + str(e))
+        elif case_sensitive == '0':
+            find_pattern = pattern.lower()
+        else:
+            find_pattern = pattern
+
     # Build search command
     cmd = []
-    use_xargs = glob_mode != 'native' and not is_win32
+    # Tools that can read the list of files to search from a file get it
+    # through 'files_from' (e.g. '--files-from={file}'), so that a single
+    # process searches all the globbed files.
+    files_from = args.get('files_from') if glob_mode != 'native' else None
+    use_xargs = glob_mode != 'native' and not is_win32 and not files_from
+    if glob_mode == 'rg' and not use_xargs:
+        files = [f.decode(preferred_encoding, 'surrogateescape') for f in files]
     if use_xargs:
         # Run each for each globbed file
         cmd.append('xargs')
         cmd.append('-0')
     for c in args['cmd']:
+        if rg_vimgrep and c in ('--json', '-0', '--null'):
+            continue
         if c != '{file_mask}' or (glob_mode == 'native' and file_mask and not native_glob_args):
             cmd.append(
                 c.format(limit=limit, pattern=pattern, file_mask=file_mask))
-    if args.get('expand_cmdargs', '0') != '0':
+    expand_cmdargs = args.get('expand_cmdargs', '0') != '0'
+    if expand_cmdargs:
         cmd += cmdargs
+    # Options go right after the tool name, ahead of the positionals and of
+    # any '--' in the template. Only the options already given are checked,
+    # not the pattern or the file mask.
+    user_opts = [c for c in args['cmd'][1:]
+                 if '{pattern}' not in c and '{file_mask}' not in c]
+    if expand_cmdargs:
+        user_opts += cmdargs
+    rg_opts = []
+    if rg_vimgrep:
+        rg_opts += [c for c in ('--vimgrep', '--no-heading', '--color=never')
+                    if c not in user_opts]
+    if source in ('rg', 'rgnvim'):
+        # Let rg skip what would be filtered out of its output anyway.
+        if not has_option(user_opts, '-m', '--max-count'):
+            rg_opts += ['--max-count', str(limit)]
+        # rg counts --max-columns in bytes while max_columns counts
+        # characters, so pass the UTF-8 worst case of 4 bytes per character
+        # and leave the exact check to the loops below.
+        if max_columns and not has_option(user_opts, '-M', '--max-columns'):
+            rg_opts += ['--max-columns', str(max_columns * 4)]
     if native_glob_args:
         cmd += native_glob_args
+    if rg_opts:
+        tool_at = 2 if use_xargs else 0
+        cmd[tool_at + 1:tool_at + 1] = rg_opts
+
+    files_list = None
+    if files_from:
+        with tempfile.NamedTemporaryFile(mode='w', delete=False,
+                                         encoding=preferred_encoding,
+                                         errors='surrogateescape') as fp:
+            fp.write('\n'.join(files) + '\n')
+        files_list = fp.name
+        cmd.append(files_from.format(file=files_list))
 
     logger.debug('cmd:' + str(cmd))
     logger.debug('pattern:' + str(pattern))
@@ -273,238 +530,262 @@ def search(ctx, args, cmdargs):
 
     # Execute search command
     try:
-        if glob_mode != 'native' and is_win32:
+        if glob_mode != 'native' and is_win32 and not files_from:
             proc = MultiProc(cmd, files, ctx['cwd'])
         else:
-            proc = subprocess.Popen(cmd, cwd=ctx['cwd'], stdin=proc_stdin,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # In its own session the tool, and the tool run by xargs, can be
+            # stopped together through the process group.
+            proc = subprocess.Popen(cmd, cwd=ctx['cwd'], stdin=proc_stdin, bufsize=PIPE_BUFSIZE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    start_new_session=not is_win32)
     except Exception as e:
+        if files_list:
+            os.remove(files_list)
         return {'error': str(e)}
 
-    # If xargs, pipe the file list to stdin
+    # If xargs, pipe the file list to stdin. This is done on a separate
+    # thread, as xargs starts the tool before it has read the whole list,
+    # and the tool's output has to be read meanwhile.
     if use_xargs:
-        sep = '\0'
-        proc.stdin.write((sep.join(files) + sep).encode(preferred_encoding))
-        proc.stdin.close()
+        if glob_mode == 'rg':
+            files_data = b'\0'.join(files) + b'\0'
+        else:
+            sep = '\0'
+            files_data = (sep.join(files) + sep).encode(preferred_encoding)
+        threading.Thread(target=write_stdin, args=(proc.stdin, files_data),
+                         daemon=True).start()
+
+    # Likewise drain stderr, so the tool never blocks writing to it while
+    # stdout is being read. MultiProc does this for each of its children.
+    stderr = None if isinstance(proc, MultiProc) else StreamDrain(proc.stderr)
 
     logger.debug('type(proc) = ' + str(type(proc)))
 
     range_ = tuple(ctx['range'])
-    result = {}
+    result = ItemsFile()
 
-    if source == 'rg' or source == 'rgnvim':
+    # Drop repeated (file, line, column) matches, e.g. when overlapping
+    # file masks pass the same file to the search tool more than once.
+    # The flag is resolved once here, so the match loops only test a local.
+    # It may come from vim as a number or as a string.
+    dedup = args.get('dedup', 0) not in (0, '0', False, None, '')
+    seen = set() if dedup else None
 
-        while limit > 0:
-            line = proc.stdout.readline()
+    if rg_json:
 
-            try:
-                line = line.decode('utf-8').rstrip()
-            except UnicodeDecodeError:
-                logger.debug(
-                    "UnicodeDecodeError: line = line.decode('utf-8').rstrip() failed, line:")
-                continue
+        for line in iter_lines(proc.stdout):
+            if limit <= 0:
+                break
 
-            if not line:
-                if len(result) == 0:
-                    err = proc.stderr.readline()
-                    if err:
-                        err = err.decode('utf-8')
-                        logger.debug('error:' + err)
-                        return {'error': err}
-
-                if proc.poll() is not None:
-                    logger.debug('end of proc. break')
-                    break
+            # Only match records are used. Skip begin/end/context/summary
+            # records with a cheap check on the raw bytes, before paying
+            # for the json decode.
+            if b'"type":"match"' not in line[:64]:
                 continue
 
-            logger.debug('proc readline: ' + line)
+            logger.debug('proc readline: %s', line)
             try:
-                item = json.loads(line)
+                item = json_loads(line)
             except JSONDecodeError as err:
-                logger.debug('json error: ' + err)
-                continue
-
-            if type(item) != dict or 'type' not in item:
-                logger.debug(
-                    'json error: item is not dict or item has no key "type". item =' + str(item))
+                logger.debug('json error: ' + str(err))
                 continue
 
-            if item['type'] == 'match':
+            try:
                 data = item['data']
                 file_name = data['path']['text']
                 lnum = data['line_number']
+                submatches = data['submatches']
+            except KeyError:
+                logger.debug('json error: malformed match item. item =' + str(item))
+                continue
 
-                try:
-                    text = data['lines']['text']
-                except KeyError:
-                    text = data['lines']['bytes']
-                except:
-                    logger.debug(
-                        "item['data']['lines'] has neigher key 'test' nor key 'bytes'. item =" + str(item))
-                    continue
-                if len(text) > max_columns:
-                    logger.debug(
-                        "File '{file_name}' line {lnum} is too long, longer than max_column {max_columns}."
-                        .format(file_name=file_name, lnum=lnum, max_columns=max_columns))
-                    continue
-                text = text.split('\n')[0]
-                text = text.rstrip()
+            try:
+                text = data['lines']['text']
+            except KeyError:
+                text = data['lines']['bytes']
+            except:
+                logger.debug(
+                    "item['data']['lines'] has neigher key 'test' nor key 'bytes'. item =" + str(item))
+                continue
+            if len(text) > max_columns:
+                logger.debug(
+                    "File '{file_name}' line {lnum} is too long, longer than max_column {max_columns}."
+                    .format(file_name=file_name, lnum=lnum, max_columns=max_columns))
+                continue
+            text = text.split('\n')[0]
+            text = text.rstrip()
 
-                for submatch in data['submatches']:
-                    match = submatch['match']['text']
+            for submatch in submatches:
+                try:
                     cnum = submatch['start'] + 1
+                    # Matched bytes that aren't valid UTF-8 come base64
+                    # encoded as 'bytes'. Leave the match out then; vim
+                    # finds it in the text itself.
+                    match = submatch['match'].get('text')
+                except (KeyError, AttributeError):
+                    logger.debug('json error: malformed submatch. item =' + str(item))
+                    continue
 
+                if dedup:
                     item_idx = (file_name, lnum, cnum)
-
-                    if 'one_file_result' in locals() or 'one_file_result' in globals():
-                        if item_idx in one_file_result:
-                            continue
-                        else:
-                            one_file_result.append(item_idx)
-
-                    if (range_[0] != -1 and range_[0] > lnum) or \
-                       (range_[1] != -1 and range_[1] < lnum):
+                    if item_idx in seen:
                         continue
+                    seen.add(item_idx)
 
-                    if not file_name in result:
-                        result[file_name] = {
-                            'fname': file_name,
-                            'items': []
-                        }
-
-                    item_ctx = {
-                        'lnum': lnum,
-                        'cnum': cnum,
-                        'text': text,
-                        'match': match
-                    }
-                    result[file_name]['items'].append(item_ctx)
+                if (range_[0] != -1 and range_[0] > lnum) or \
+                   (range_[1] != -1 and range_[1] < lnum):
+                    continue
 
-                    limit -= 1
+                result.add(file_name, lnum, cnum, text, match)
 
-    else:
-        if submatch_type == 'first':
-            if regex != '0':
-                try:
-                    if case_sensitive == '0':
-                        cpat = re.compile(pattern, re.IGNORECASE)
-                    else:
-                        cpat = re.compile(pattern)
-                except Exception as e:
-                    return {'error': 'invalid pattern: ' + str(e)}
+                limit -= 1
+                if limit <= 0:
+                    break
 
-        while limit > 0:
-            line = proc.stdout.readline()
+            # Stop as soon as the limit is reached instead of waiting for the
+            # tool to print another line; the tool is terminated below.
+            if limit <= 0:
+                break
 
-            try:
-                line = line.decode('utf-8').rstrip()
-            except UnicodeDecodeError:
-                logger.debug(
-                    "UnicodeDecodeError: line = line.decode('utf-8').rstrip() failed, line:")
-                continue
+    else:
+        for line in iter_lines(proc.stdout):
+            if limit <= 0:
+                break
 
+            line = line.rstrip()
             if not line:
-                if len(result) == 0:
-                    err = proc.stderr.readline()
-                    if err:
-                        err = err.decode('utf-8')
-                        logger.debug('error:' + err)
-                        return {'error': err}
-
-                if proc.poll() is not None:
-                    logger.debug('end of proc. break')
-                    break
                 continue
 
-            items = re.split(':', line, 3)
-            if len(items) != 4:
-                logger.error('broken line:' + line)
+            m = LINE_RE.match(line)
+            if not m:
+                logger.error('broken line: %s', line)
                 continue
 
-            file_name = items[0]
-            lnum = int(items[1])
-            cnum = int(items[2])
-            text = items[3]
+            lnum = int(m.group(2))
+            cnum = int(m.group(3))
+
+            # rg only omits lines longer than max_columns in any encoding,
+            # see --max-columns above.
+            if rg_vimgrep and OMITTED_LINE_RE.match(m.group(4)):
+                logger.debug(
+                    "File '{file_name}' line {lnum} is too long, longer than max_column {max_columns}."
+                    .format(file_name=decode_output(m.group(1)), lnum=lnum, max_columns=max_columns))
+                continue
 
             if (range_[0] != -1 and range_[0] > lnum) or \
                (range_[1] != -1 and range_[1] < lnum):
                 continue
 
-            if len(text) > max_columns:
+            # A line never has more characters than bytes, so only long
+            # non-ASCII lines need decoding to be checked against max_columns.
+            text = m.group(4)
+            is_ascii = text.isascii()
+            if len(text) > max_columns and \
+               (is_ascii or len(text.decode('utf-8', 'replace')) > max_columns):
                 logger.debug(
                     "File '{file_name}' line {lnum} is too long, longer than max_column {max_columns}."
-                    .format(file_name=file_name, lnum=lnum, max_columns=max_columns))
+                    .format(file_name=decode_output(m.group(1)), lnum=lnum, max_columns=max_columns))
                 continue
 
-            item_idx = (file_name, lnum, cnum)
-            if 'one_file_result' in locals() or 'one_file_result' in globals():
-                if item_idx in one_file_result:
+            file_name = decode_output(m.group(1))
+            # Byte columns can only be mapped to characters of valid UTF-8
+            # text, so further matches are not looked for on other lines.
+            raw_text = text
+            is_utf8 = True
+            if is_ascii:
+                text = str(raw_text, 'ascii')
+            else:
+                try:
+                    text = raw_text.decode('utf-8')
+                except UnicodeDecodeError:
+                    text = raw_text.decode('utf-8', 'replace')
+                    is_utf8 = False
+
+            if dedup:
+                item_idx = (file_name, lnum, cnum)
+                if item_idx in seen:
                     continue
-                else:
-                    one_file_result.append(item_idx)
-
-            if not file_name in result:
-                file_ctx = {
-                    'fname': file_name,
-                    'items': []
-                }
-                result[file_name] = file_ctx
-            file_ctx = result[file_name]
-
-            item_ctx = {}
-            item_ctx['text'] = text
-            item_ctx['lnum'] = lnum
-            item_ctx['cnum'] = cnum
-            file_ctx['items'].append(item_ctx)
+                seen.add(item_idx)
+
+            result.add(file_name, lnum, cnum, text)
             limit -= 1
 
-            if submatch_type == 'first':
-                byte_num = item_ctx['cnum']
-                char_num = len(text.encode('utf-8')
-                               [:byte_num-1].decode('utf-8'))
+            if find_submatches and is_utf8 and limit > 0:
+                # Columns are byte offsets. For ASCII text, the common case,
+                # they are equal to character offsets.
+                if is_ascii:
+                    char_num = cnum - 1
+                else:
+                    char_num = len(raw_text[:cnum-1].decode('utf-8', 'replace'))
                 move_cnum = char_num + 1
 
                 if regex == '0':
+                    search_text = text.lower() if case_sensitive == '0' else text
                     while True:
-                        next_item_ctx = {}
-                        next_item_ctx['text'] = text
-                        next_item_ctx['lnum'] = int(lnum)
-                        if case_sensitive == '0':
-                            next_char_num = text.lower().find(pattern.lower(), move_cnum)
-                        else:
-                            next_char_num = text.find(pattern, move_cnum)
+                        next_char_num = search_text.find(find_pattern, move_cnum)
                         if next_char_num == -1:
                             break
                         move_cnum = next_char_num + 1
-                        prefix = text[:next_char_num]
-                        next_item_ctx['cnum'] = len(prefix.encode('utf-8')) + 1
-                        file_ctx['items'].append(next_item_ctx)
+                        if is_ascii:
+                            next_cnum = next_char_num + 1
+                        else:
+                            prefix = text[:next_char_num]
+                            next_cnum = len(prefix.encode('utf-8')) + 1
+                        result.add(file_name, lnum, next_cnum, text)
                         limit -= 1
                         if limit <= 0:
                             break
                 else:
-                    for cp in cpat.finditer(text, move_cnum):
-                        next_item_ctx = {}
-                        next_item_ctx['text'] = text
-                        next_item_ctx['lnum'] = int(lnum)
-                        prefix = text[:cp.span()[0]]
-                        next_item_ctx['cnum'] = len(prefix.encode('utf-8')) + 1
-                        file_ctx['items'].append(next_item_ctx)
+                    line_cpat = ascii_cpat if is_ascii else cpat
+                    for cp in line_cpat.finditer(text, move_cnum):
+                        if is_ascii:
+                            next_cnum = cp.start() + 1
+                        else:
+                            prefix = text[:cp.start()]
+                            next_cnum = len(prefix.encode('utf-8')) + 1
+                        result.add(file_name, lnum, next_cnum, text)
                         limit -= 1
                         if limit <= 0:
                             break
 
+            # Stop as soon as the limit is reached instead of waiting for the
+            # tool to print another line; the tool is terminated below.
+            if limit <= 0:
+                break
+
     try:
-        proc.terminate()
+        if isinstance(proc, MultiProc) or is_win32:
+            proc.terminate()
+        else:
+            os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
     except Exception as e:
         logger.error('failed to terminate proc: ' + str(e))
 
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8') as fp:
-        for file_ctx in result.values():
-            json.dump(file_ctx, fp, ensure_ascii=False)
-            fp.write('\n')
+    # A tool that is still writing gets EPIPE rather than filling the pipe.
+    if not isinstance(proc, MultiProc):
+        try:
+            proc.stdout.close()
+        except Exception as e:
+            logger.debug('failed to close proc stdout: ' + str(e))
 
-    logger.debug('items_file:' + fp.name)
-    final_result['items_file'] = fp.name
+    if files_list:
+        try:
+            proc.wait()
+            os.remove(files_list)
+        except Exception as e:
+            logger.error('failed to remove files list: ' + str(e))
+
+    if result.empty:
+        err = (stderr or proc.stderr).readline()
+        if err:
+            err = err.decode('utf-8')
+            logger.debug('error:' + err)
+            return {'error': err}
+
+    items_file = result.close()
+    logger.debug('items_file:' + items_file)
+    final_result['items_file'] = items_file
 
     return final_result